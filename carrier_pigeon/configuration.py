@@ -2,10 +2,17 @@
 
 import os
 import os.path
+import sys
+import time
 import shutil
 import logging
+from datetime import datetime
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
+from django.db import connection
+from django.template.defaultfilters import date as format_date
 
 from carrier_pigeon.models import ItemToPush
 from carrier_pigeon.senders import DummySender, FTPSender, FTPSSender, SFTPSender
@@ -32,6 +39,11 @@ class DefaultConfiguration(object):
         'dummy': DummySender,
     }
 
+    # Models this configuration may push. Only sequential configurations use
+    # it, to skip the models they never handle when selecting saved objects.
+    # None means any model.
+    handled_models = None
+
     @property
     def name(self):
         return self.__class__.__name__.lower()
@@ -45,12 +57,22 @@ class DefaultConfiguration(object):
             logger.warning(u'No push url setted for rule "%s"' % self.name)
             return []
 
-    def initialize_push(self):
-        """ Right here, it's nothing more than a placeholder, but you may use
-        this method in your subclass if you need a hook to execute some code
-        before looping on the items to export. """
+    # Packer the output makers are writing into, see ZIPPacker
+    _stream = None
 
-        pass
+    def initialize_push(self):
+        """ Hook to execute some code before looping on the items to export.
+        Call it from your subclass to let streaming packers (ZIPPacker) open
+        their archive. """
+
+        if self._stream is not None:
+            # Left open by a push that failed
+            self._stream.close()
+            self._stream = None
+        if getattr(self, 'packer', None) and getattr(self.packer,
+                                                     'streaming', False):
+            self._stream = self.packer(self, [])
+            self._stream.open()
 
     def get_supervisor_for_item(self, item):
         """
@@ -195,17 +217,26 @@ class DefaultConfiguration(object):
                     continue  # We don't want the export process to be stopped
                               # Jump to next output
 
-            # --- Create output directory if necessary
-            if not os.path.exists(output_maker.local_final_directory):
-                os.makedirs(output_maker.local_final_directory)
-
-            # --- Release the final file locally
-            local_final_path = self.prevent_from_failing(
-                output_maker.release,
-                ItemToPush.STATUS.OUTPUT_GENERATION_ERROR,
-                row,
-                func_args=[output],
-            )
+            if self._stream is not None:
+                # --- Write the final file in the streamed archive
+                local_final_path = self.prevent_from_failing(
+                    self._stream.add,
+                    ItemToPush.STATUS.OUTPUT_GENERATION_ERROR,
+                    row,
+                    func_args=[output_maker, output],
+                )
+            else:
+                # --- Create output directory if necessary
+                if not os.path.exists(output_maker.local_final_directory):
+                    os.makedirs(output_maker.local_final_directory)
+
+                # --- Release the final file locally
+                local_final_path = self.prevent_from_failing(
+                    output_maker.release,
+                    ItemToPush.STATUS.OUTPUT_GENERATION_ERROR,
+                    row,
+                    func_args=[output],
+                )
 
             if local_final_path:
                 logger.warning("File added to output: %s" % local_final_path)
@@ -229,6 +260,9 @@ class DefaultConfiguration(object):
     def pack(self, files):
         if not files:
             pass # must stop process here
+        if self._stream is not None:
+            stream, self._stream = self._stream, None
+            return stream.close()
         packer = self.packer(self, files)
         return packer.pack()
 
@@ -243,14 +277,16 @@ class DefaultConfiguration(object):
         """
         raise NotImplementedError()
 
-    def deliver(self, files, target_url, row=None):
-        """Defines from url scheme the right sender to use, and calls it."""
+    def deliver(self, files, target_url, row=None, deadline=None):
+        """Defines from url scheme the right sender to use, and calls it.
+
+        The delivery is stopped at the ``deadline`` time.time(), if any."""
         try:
             sender_class = self.SENDER_MAPPING[target_url.scheme]
         except KeyError:
             logger.error('url scheme %s not supported' % target_url.scheme)
         else:
-            sender = sender_class(self)
+            sender = sender_class(self, deadline)
             return sender.deliver(files, target_url, row)
 
 
@@ -260,8 +296,13 @@ class SequentialPusherConfiguration(DefaultConfiguration):
     destination server one by one, progressively.
 
     Associated management command: python manage.py pigeon_push
+
+    Set `batch_push` to True to push together the rows claimed at once for
+    the same url: their files are packed and delivered in a single session.
     """
 
+    batch_push = False
+
     def finalize_push(self, files, row):
         """
         Send packed files to row.push_url.
@@ -279,6 +320,45 @@ class SequentialPusherConfiguration(DefaultConfiguration):
         # --- Cleanup the mess
         self.cleanup()
 
+    def finalize_batch_push(self, files, rows):
+        """
+        Send packed files of all `rows` at once to their push url.
+        """
+
+        # --- Rows in error while making their output are left as is
+        rows = [row for row in rows
+                if row.status == ItemToPush.STATUS.IN_PROGRESS]
+
+        if rows:
+            # --- Pack exported files
+            files = self.pack(files)
+
+            target_url = rows[0].push_url
+            logger.debug('export_items(): target url: ``%s``' % target_url)
+            target_url = URL(target_url)
+
+            sent = self.deliver(files, target_url)
+
+            now = format_date(datetime.now(), settings.DATETIME_FORMAT)
+            if sent:
+                status = ItemToPush.STATUS.PUSHED
+                message = u"[%s] push SUCCESS (batch of %s items)" % (
+                    now, len(rows))
+            else:
+                status = ItemToPush.STATUS.SEND_ERROR
+                message = u"[%s] push ERROR (batch of %s items) TARGET: %s" % (
+                    now, len(rows), target_url.domain)
+            ItemToPush.objects.filter(pk__in=[row.pk for row in rows]).update(
+                status=status,
+                message=message,
+            )
+            for row in rows:
+                row.status = status
+                row.message = message
+
+        # --- Cleanup the mess
+        self.cleanup()
+
 
 class MassPusherConfiguration(DefaultConfiguration):
     """
@@ -295,14 +375,72 @@ class MassPusherConfiguration(DefaultConfiguration):
     def finalize_push(self, files, row=None):
         """
         Send packed files one time per push url.
+
+        All push urls are delivered at the same time, each one within its
+        `push_timeout` option or CARRIER_PIGEON_PUSH_TIMEOUT seconds if
+        any: the transfer in progress is then stopped. Returns the delivery
+        result of each push url.
         """
 
         # --- Pack exported files
         files = self.pack(files)
 
-        # --- Deliver newly-created archive to destination
-        for push_url in self.push_urls:
-            self.deliver(files, URL(push_url))
+        # --- Deliver newly-created archive to destinations
+        results = {}
+        push_urls = list(self.push_urls)
+        if push_urls:
+            start = time.time()
+            default_timeout = getattr(settings, 'CARRIER_PIGEON_PUSH_TIMEOUT',
+                                      None)
+            deadlines = {}
+            for push_url in push_urls:
+                timeout = URL(push_url).options.get('push_timeout',
+                                                    default_timeout)
+                if timeout is not None:
+                    deadlines[push_url] = start + float(timeout)
+            pool = ThreadPool(len(push_urls))
+            deliveries = [
+                (push_url, pool.apply_async(
+                    self.deliver_in_thread,
+                    (files, URL(push_url), deadlines.get(push_url))))
+                for push_url in push_urls
+            ]
+            pool.close()
+            for push_url, delivery in deliveries:
+                timeout = None
+                if push_url in deadlines:
+                    timeout = max(0, deadlines[push_url] - time.time())
+                results[push_url] = self.wait_for_delivery(push_url,
+                                                           delivery, timeout)
+            # The deliveries stop at their deadline, don't clean up under
+            # them
+            pool.join()
 
         # --- Cleanup the mess
         self.cleanup()
+
+        return results
+
+    def deliver_in_thread(self, files, target_url, deadline):
+        """ `deliver` run by a thread of `finalize_push`. """
+        try:
+            return self.deliver(files, target_url, deadline=deadline)
+        finally:
+            # Django opens a database connection per thread
+            connection.close()
+
+    def wait_for_delivery(self, push_url, delivery, timeout):
+        """
+        Returns the result of a delivery started by `finalize_push`, False if
+        it failed or did not end within `timeout` seconds.
+        """
+        try:
+            # A timeout is needed for the wait to be interruptible
+            return bool(delivery.get(timeout if timeout is not None
+                                     else sys.maxint))
+        except TimeoutError:
+            logger.error(u'Delivery to %s timed out' % URL(push_url).domain)
+        except Exception, e:
+            logger.error(u'Delivery to %s failed: %s' % (
+                URL(push_url).domain, e), exc_info=True)
+        return False
@@ -1,43 +1,130 @@
 import logging
 
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+
 from carrier_pigeon.models import ItemToPush
-from carrier_pigeon.utils import duplicate_row
+from carrier_pigeon.utils import RecentKeys
 
 
 logger = logging.getLogger('carrier_pigeon.facility')
 
+# Items queued by this process lately, to skip the duplicates lookup during
+# bursts of saves (see CARRIER_PIGEON_DEDUP_CACHE_SIZE)
+RECENTLY_QUEUED = RecentKeys(
+    getattr(settings, 'CARRIER_PIGEON_DEDUP_CACHE_SIZE', 0),
+    getattr(settings, 'CARRIER_PIGEON_DEDUP_CACHE_TIMEOUT', 60),
+)
+
 
 def add_item_to_push(instance, rule_name):
     """Adds an item to ``ItemToPush`` table aka. push queue"""
-    logger.debug('adding %s pk=%s for %s config' % (
-        type(instance).__name__,
-        instance.pk,
-        rule_name
-    ))
+    add_items_to_push([(instance, rule_name)])
+
+
+def add_items_to_push(items):
+    """Adds many items to ``ItemToPush`` table aka. push queue.
+
+    ``items`` is an iterable of ``(instance, rule_name)`` pairs. Items already
+    waiting in the queue are looked up with a single query and all new rows
+    are inserted at once."""
 
     from carrier_pigeon.registry import REGISTRY
 
-    try:
-        rule = REGISTRY[rule_name]
-    except KeyError:
-        logger.warning(u'Asked rule "%s" does not exist (instance : %s %d)'
-                        % (rule_name, instance.__class__.__name__, instance.pk))
+    candidates = []
+    seen = set()
+    for instance, rule_name in items:
+        logger.debug('adding %s pk=%s for %s config' % (
+            type(instance).__name__,
+            instance.pk,
+            rule_name
+        ))
+        try:
+            rule = REGISTRY[rule_name]
+        except KeyError:
+            logger.warning(u'Asked rule "%s" does not exist (instance : %s %d)'
+                            % (rule_name, instance.__class__.__name__,
+                               instance.pk))
+            continue
+        content_type = ContentType.objects.get_for_model(instance)
+        key = (rule_name, content_type.pk, instance.pk)
+        if key in seen:
+            continue
+        seen.add(key)
+        candidates.append((key, instance, rule, content_type))
+
+    if not candidates:
         return
 
-    if duplicate_row(rule_name, instance):
-        # The item is already in the queue for this url
-        logger.debug('This item is already in the queue... skipping.')
+    keys = [key for key, _, _, _ in candidates]
+    unique_queue = getattr(settings, 'CARRIER_PIGEON_UNIQUE_QUEUE', False)
+    if unique_queue:
+        # The unique index rejects the duplicates, don't look them up
+        queued = set(key for key in keys if key in RECENTLY_QUEUED)
     else:
+        queued = queued_keys(keys)
+
+    rows = []
+    selected = []
+    for key, instance, rule, content_type in candidates:
+        if key in queued:
+            # The item is already in the queue for this url
+            logger.debug('%s pk=%s is already in the queue for %s... '
+                         'skipping.' % (type(instance).__name__, instance.pk,
+                                        rule.name))
+            continue
         for push_url in rule.push_urls:
-            row = ItemToPush(rule_name=rule_name,
-                             content_object=instance,
-                             push_url=push_url)
-            row.save()
-            logger.debug('Added item in the ItemToPush queue @ %s' %
-                         row.pk)
+            rows.append(ItemToPush(rule_name=rule.name,
+                                   content_type=content_type,
+                                   object_id=instance.pk,
+                                   push_url=push_url))
+        selected.append((key, instance, rule))
+
+    if unique_queue:
+        inserted = ItemToPush.objects.insert_ignoring_duplicates(rows)
+        selected = [s for s in selected if s[0] in inserted]
+        logger.debug('Added %s new item(s) in the ItemToPush queue'
+                     % len(selected))
+    else:
+        insert_rows(rows)
+        logger.debug('Added %s item(s) in the ItemToPush queue' % len(rows))
+    for key in keys:
+        RECENTLY_QUEUED.add(key)
+
+    for _, instance, rule in selected:
         try:
             model_supervisor = rule.get_supervisor_for_item(instance)
         except:
             pass
         else:
             model_supervisor.post_select(instance)
+
+
+def queued_keys(keys):
+    """Returns the subset of ``(rule_name, content_type_id, object_id)``
+    ``keys`` having a NEW row in the queue, using at most one query."""
+    queued = set(key for key in keys if key in RECENTLY_QUEUED)
+    keys = [key for key in keys if key not in queued]
+    if not keys:
+        return queued
+    rule_names, content_type_ids, object_ids = [set(k) for k in zip(*keys)]
+    query = ItemToPush.objects.new().filter(
+        rule_name__in=rule_names,
+        content_type__in=content_type_ids,
+        object_id__in=object_ids,
+    )
+    found = query.values_list('rule_name', 'content_type', 'object_id')
+    return queued | (set(found) & set(keys))
+
+
+def insert_rows(rows):
+    """Saves new ``ItemToPush`` rows at once.
+
+    No transaction handling here: ``select()`` runs in ``post_save``, the
+    rows must join the transaction of the caller, as ``row.save()`` does."""
+    if not rows:
+        return
+    if hasattr(ItemToPush.objects, 'bulk_create'):
+        ItemToPush.objects.bulk_create(rows)
+    else:
+        ItemToPush.objects.insert_rows(rows)
@@ -15,7 +15,8 @@ class Command(BaseCommand):
     - it returns exit code 0 if everything is OK.
 
     - it returns exit code *2* if there are new items 
-      ``CARRIER_PIGEON_CHECK_OLD_AGE`` seconds old or more
+      ``CARRIER_PIGEON_CHECK_OLD_AGE`` seconds old or more, or items
+      in progress whose worker lease expired
     
     - it returns exit code *1* if there are new items 
       ``CARRIER_PIGEON_CHECK_TOO_OLD_AGE`` seconds old or more but
@@ -33,6 +34,9 @@ class Command(BaseCommand):
         if min30_count > 0:
             sys.exit(2)
 
+        if ItemToPush.objects.expired_leases().count() > 0:
+            sys.exit(2)
+
 
         min10 = timedelta(seconds=CARRIER_PIGEON_CHECK_TOO_OLD_AGE)
         min10_count = ItemToPush.objects.filter(creation_date__lt=now-min10,
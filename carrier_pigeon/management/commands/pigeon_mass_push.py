@@ -6,6 +6,7 @@ from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 
 from carrier_pigeon.registry import REGISTRY
+from carrier_pigeon.senders import CONNECTION_POOL
 
 
 logger = logging.getLogger('carrier_pigeon.command.mass_push')
@@ -28,5 +29,8 @@ class Command(BaseCommand):
             files = []
             for item in rule.get_items_to_push(*args[1:]):
                 files += rule.process_item(item)
-            rule.finalize_push(files)
+            try:
+                rule.finalize_push(files)
+            finally:
+                CONNECTION_POOL.close_all()
             self.stdout.write('Job ran correctly')
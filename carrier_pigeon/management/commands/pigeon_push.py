@@ -3,69 +3,259 @@
 """ Push items in the ItemToPush queue. """
 
 import os
+import time
+import signal
+import socket
 import logging
-from datetime import datetime
+from optparse import make_option
 
 from django.conf import settings
+from django.db import reset_queries
+from django.db import transaction
 from django.core.management.base import BaseCommand
 
 from carrier_pigeon.registry import REGISTRY
+from carrier_pigeon.models import Destination
 from carrier_pigeon.models import ItemToPush
+from carrier_pigeon.senders import CONNECTION_POOL
+from carrier_pigeon.utils import URL
 
 
 logger = logging.getLogger('carrier_pigeon.command.push')
 
 
-def item_to_push_queue():
+def default_worker():
+    """ Name identifying this process among the other push workers. """
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def claim_batch(worker):
     """
-    Generator.
-    
-    Retrieve rows in queue.
+    Claim the next batch of rows in queue for `worker`.
     """
     offset = getattr(settings, "CARRIER_SELECT_OFFSET", 10)
-    while True:
-        qs = ItemToPush.objects.all()
-        qs = qs.order_by('creation_date')
-        qs = qs.filter(status=ItemToPush.STATUS.NEW)
-        rows = qs[:offset]  # don't retrieve too many rows at once
-        if len(rows) == 0:
-            return
-        for row in rows:
-            yield row
+    # Give back to the queue rows of the workers that died
+    reaped = ItemToPush.objects.reap_expired_leases()
+    if reaped:
+        logger.warning(u'%s expired lease(s) put back in queue' % reaped)
+    # don't retrieve too many rows at once
+    return ItemToPush.objects.claim(worker, offset)
 
 
 class Command(BaseCommand):
     """ Push items in the ItemToPush queue. """
     help = __doc__
 
+    option_list = BaseCommand.option_list + (
+        make_option('--worker',
+            action='store',
+            dest='worker',
+            default=None,
+            help='Name of this worker, defaults to <hostname>:<pid>'),
+        make_option('--daemon',
+            action='store_true',
+            dest='daemon',
+            default=False,
+            help='Keep polling the queue instead of exiting once it is empty'),
+        make_option('--min-interval',
+            action='store',
+            type='float',
+            dest='min_interval',
+            default=getattr(settings, 'CARRIER_PIGEON_POLL_MIN_INTERVAL', 0.5),
+            help='Daemon mode: seconds to wait once the queue is drained'),
+        make_option('--max-interval',
+            action='store',
+            type='float',
+            dest='max_interval',
+            default=getattr(settings, 'CARRIER_PIGEON_POLL_MAX_INTERVAL', 30),
+            help='Daemon mode: longest wait between two polls of an idle queue'),
+        )
+
+    stopping = False
+
+    def stop(self, signum, frame):
+        """ Signal handler: exit once the current batch is pushed. """
+        logger.info(u'signal %s received, stopping after current batch'
+                    % signum)
+        self.stopping = True
+
     def handle(self, *args, **options):
+        worker = options.get('worker') or default_worker()
+
+        try:
+            if options.get('daemon'):
+                self.run_daemon(worker, options['min_interval'],
+                                options['max_interval'])
+            else:
+                while True:
+                    rows = claim_batch(worker)
+                    if not rows:
+                        break
+                    self.push_rows(rows)
+        finally:
+            CONNECTION_POOL.close_all()
 
-        for row in item_to_push_queue():
-            rule_name = row.rule_name
+    def run_daemon(self, worker, min_interval, max_interval):
+        """
+        Push rows as they come until SIGTERM or SIGINT.
+
+        The queue is polled again right away while there are rows to push;
+        once it is idle, the wait between two polls doubles up to
+        `max_interval`.
+        """
+        previous_handlers = dict(
+            (signum, signal.signal(signum, self.stop))
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        )
+        logger.info(u'worker %s started' % worker)
+
+        try:
+            interval = min_interval
+            while not self.stopping:
+                start = time.time()
+                rows = claim_batch(worker)
+                self.push_rows(rows)
+                # Queries are stored when DEBUG is on, don't leak them
+                reset_queries()
+                CONNECTION_POOL.evict()
+
+                if rows:
+                    logger.info(u'pushed %s row(s) in %.3fs' % (
+                        len(rows), time.time() - start))
+                    interval = min_interval
+                    continue
+
+                logger.debug(u'queue empty, polled in %.3fs, '
+                             u'next poll in %.1fs'
+                             % (time.time() - start, interval))
+                if not self.stopping:
+                    self.wait(interval)
+                interval = min(interval * 2, max_interval)
+        finally:
+            for signum, handler in previous_handlers.iteritems():
+                signal.signal(signum, handler)
+
+        logger.info(u'worker %s stopped' % worker)
+
+    def wait(self, interval):
+        """ Wait before polling an idle queue again. """
+        time.sleep(interval)
+
+    def push_rows(self, rows):
+        """
+        Push claimed rows, grouping them by url for the rules pushing
+        batches.
+        """
+        batches = {}
+        batch_keys = []  # keep the queue order
+        blocked = {}
+        for row in rows:
             try:
-                rule = REGISTRY[rule_name]
-            except KeyError:
-                logger.warning(
-                    u'Asked rule "%s" does not exist (instance : %s %d)' % (
-                        rule_name, 
-                        row.content_object.__class__.__name__, 
-                        row.content_object.pk,
-                    )
-                )
-                row.status = ItemToPush.STATUS.PUSH_ERROR
-                row.save()
+                # Don't bother pushing to hosts whose circuit is open
+                host = URL(row.push_url).domain
+                if blocked.get(host) is None:
+                    # Checked again after each push: the previous row may
+                    # have opened or closed the circuit
+                    blocked[host] = Destination.objects.blocked_until(host)
+                if blocked[host] is not None:
+                    logger.info(u'%s unavailable, row id=%s postponed until '
+                                u'%s' % (host, row.pk, blocked[host]))
+                    row.postpone(blocked[host])
+                    continue
+
+                rule = REGISTRY.get(row.rule_name)
+                if rule is None or not getattr(rule, 'batch_push', False):
+                    self.push_row(row)
+                    continue
+            except Exception, e:
+                self.push_failed([row], e)
                 continue
+            key = (row.rule_name, row.push_url)
+            if key not in batches:
+                batches[key] = []
+                batch_keys.append(key)
+            batches[key].append(row)
+
+        for key in batch_keys:
+            try:
+                self.push_batch(REGISTRY[key[0]], batches[key])
+            except Exception, e:
+                self.push_failed(batches[key], e)
 
-            logger.debug(u'processing row id=%s, rule_name=%s' %
-                                                        (row.pk, row.rule_name))
-            # Hook at init
-            # (Does this make sense here? Rules instance are persistent...)
-            rule.initialize_push()
-            # Store the fact that we are working on this item
-            # (It will not appear anymore in the queue)
-            row.status = ItemToPush.STATUS.IN_PROGRESS
+    def push_failed(self, rows, exception):
+        """
+        Flag PUSH_ERROR the `rows` whose push raised `exception`, so that
+        one bad row neither stops the worker nor holds the rest of the
+        batch until its lease expires.
+        """
+        logger.error(u'push of row(s) id=%s failed: %s' % (
+            u','.join(unicode(row.pk) for row in rows), exception),
+            exc_info=True)
+        # A database error may have broken the current transaction
+        transaction.rollback_unless_managed()
+        message = u'Exception ``%s`` raised: %s' % (
+            exception.__class__.__name__, exception)
+        for row in rows:
+            ItemToPush.objects.filter(
+                pk=row.pk,
+                status=ItemToPush.STATUS.IN_PROGRESS,
+                lease_owner=row.lease_owner,
+            ).update(
+                status=ItemToPush.STATUS.PUSH_ERROR,
+                message=message,
+                lease_owner=u'',
+                lease_expiration_date=None,
+            )
+
+    def push_batch(self, rule, rows):
+        # See push_row()
+        leased_rows = []
+        for row in rows:
+            if ItemToPush.objects.renew_lease(row):
+                leased_rows.append(row)
+            else:
+                logger.warning(u'lost lease on row id=%s, skipping' % row.pk)
+        if not leased_rows:
+            return
+
+        logger.debug(u'processing rows id=%s, rule_name=%s' % (
+            u','.join(unicode(row.pk) for row in leased_rows), rule.name))
+        rule.initialize_push()
+        files = []
+        for row in leased_rows:
+            files += rule.process_item(row.content_object, row)
+        rule.finalize_batch_push(files, leased_rows)
+
+    def push_row(self, row):
+        rule_name = row.rule_name
+        try:
+            rule = REGISTRY[rule_name]
+        except KeyError:
+            logger.warning(
+                u'Asked rule "%s" does not exist (instance : %s %d)' % (
+                    rule_name, 
+                    row.content_object.__class__.__name__, 
+                    row.content_object.pk,
+                )
+            )
+            row.status = ItemToPush.STATUS.PUSH_ERROR
             row.save()
-            # Do the job
-            files = rule.process_item(row.content_object, row)
-            # Final hook
-            rule.finalize_push(files, row)
+            return
+
+        # Other rows of the batch may have taken long, make sure this
+        # one was not reaped and claimed again by another worker
+        if not ItemToPush.objects.renew_lease(row):
+            logger.warning(u'lost lease on row id=%s, skipping' % row.pk)
+            return
+
+        logger.debug(u'processing row id=%s, rule_name=%s' %
+                                                    (row.pk, row.rule_name))
+        # Hook at init
+        # (Does this make sense here? Rules instance are persistent...)
+        rule.initialize_push()
+        # The row was claimed IN_PROGRESS by claim_batch()
+        # (It will not appear anymore in the queue)
+        # Do the job
+        files = rule.process_item(row.content_object, row)
+        # Final hook
+        rule.finalize_push(files, row)
@@ -1,11 +1,35 @@
+import logging
+from datetime import datetime
+from datetime import timedelta
 from new import instancemethod
 
 import models
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.db import router
+from django.db import transaction
 from django.db import models as django_models
+from django.db.models import F
+from django.db.models import Q
+from django.db.models import AutoField
+from django.db.models.expressions import ExpressionNode
+
+logger = logging.getLogger('carrier_pigeon.managers')
 
 NOT_CONSTANTS = ["CHOICES", "CHOICES_DICT", "REVERTED_CHOICES_DICT"]
 
+# Database vendors known to support ``SELECT ... FOR UPDATE SKIP LOCKED``
+SKIP_LOCKED_VENDORS = ('postgresql', 'mysql')
+
+
+def lease_expiration_date():
+    """Expiration date of a lease taken now."""
+    duration = getattr(settings, 'CARRIER_PIGEON_LEASE_DURATION', 60*60)
+    return datetime.now() + timedelta(seconds=duration)
+
+
 # BASE
 class BaseQuerySet(django_models.query.QuerySet):
     def failed(self):
@@ -23,6 +47,387 @@ class BaseManager(django_models.Manager):
     def failed(self):
         return self.get_query_set().failed()
 
+    def claim(self, worker, limit=10):
+        """Atomically lease at most ``limit`` of the oldest NEW rows to
+        ``worker``.
+
+        Claimed rows are flagged IN_PROGRESS and owned by ``worker`` before
+        being returned, so concurrent ``pigeon_push`` processes never get the
+        same row. ``SELECT ... FOR UPDATE SKIP LOCKED`` is used when the
+        database supports it (see ``CARRIER_PIGEON_SKIP_LOCKED``), a
+        conditional UPDATE otherwise."""
+        using = router.db_for_write(self.model)
+        connection = connections[using]
+        skip_locked = getattr(settings, 'CARRIER_PIGEON_SKIP_LOCKED', True)
+        if skip_locked and connection.vendor in SKIP_LOCKED_VENDORS:
+            return self._claim_skip_locked(worker, limit, using)
+        return self._claim_conditional_update(worker, limit, using)
+
+    def _lease(self, pks, worker, using):
+        """Flag NEW rows among ``pks`` as leased by ``worker``.
+
+        Returns the number of rows actually leased."""
+        qs = self.get_query_set().using(using)
+        qs = qs.filter(pk__in=pks, status=models.ITEM_TO_PUSH_STATUS.NEW)
+        return qs.update(status=models.ITEM_TO_PUSH_STATUS.IN_PROGRESS,
+                         lease_owner=worker,
+                         lease_expiration_date=lease_expiration_date(),
+                         last_push_attempts_date=datetime.now())
+
+    def _claimed(self, pks, worker, using):
+        qs = self.get_query_set().using(using)
+        qs = qs.filter(pk__in=pks,
+                       status=models.ITEM_TO_PUSH_STATUS.IN_PROGRESS,
+                       lease_owner=worker)
+        return list(qs.order_by('creation_date'))
+
+    def claimable(self):
+        """NEW rows, oldest first, skipping those to retry later."""
+        qs = self.get_query_set().new()
+        qs = qs.filter(Q(next_attempt_date__isnull=True)
+                       | Q(next_attempt_date__lte=datetime.now()))
+        return qs.order_by('creation_date')
+
+    def _claim_skip_locked(self, worker, limit, using):
+        connection = connections[using]
+        qs = self.claimable().using(using).values_list('pk', flat=True)
+        sql, params = qs[:limit].query.get_compiler(using).as_sql()
+        sql += ' FOR UPDATE SKIP LOCKED'
+
+        @transaction.commit_on_success(using=using)
+        def lease():
+            cursor = connection.cursor()
+            cursor.execute(sql, params)
+            pks = [pk for pk, in cursor.fetchall()]
+            if pks:
+                self._lease(pks, worker, using)
+            return pks
+
+        pks = lease()
+        if not pks:
+            return []
+        return self._claimed(pks, worker, using)
+
+    def _claim_conditional_update(self, worker, limit, using):
+        while True:
+            qs = self.claimable().using(using)
+            pks = list(qs.values_list('pk', flat=True)[:limit])
+            if not pks:
+                return []
+            # The status condition in the UPDATE makes sure only one worker
+            # wins each row; if others took all of them, try the next ones.
+            if self._lease(pks, worker, using):
+                return self._claimed(pks, worker, using)
+
+    def insert_rows(self, rows):
+        """Insert new ``rows`` with one multi-row ``INSERT`` statement.
+
+        ``bulk_create()`` for Django < 1.4, rows are inserted in batches
+        on SQLite which limits the number of parameters of a query."""
+        if not rows:
+            return
+        using = router.db_for_write(self.model)
+        connection = connections[using]
+        into, values, params = self._insert_sql(rows, connection)
+        batch_size = len(rows)
+        if connection.vendor == 'sqlite':
+            batch_size = max(1, 999 // len(params[0]))
+        cursor = connection.cursor()
+        for i in xrange(0, len(rows), batch_size):
+            batch = params[i:i + batch_size]
+            cursor.execute('INSERT ' + into + ', '.join([values] * len(batch)),
+                           sum(batch, []))
+        # Like Model.save(): join the transaction of the caller, if any
+        transaction.commit_unless_managed(using=using)
+
+    def insert_ignoring_duplicates(self, rows):
+        """Insert new ``rows``, skipping those already waiting in the queue.
+
+        Relies on the unique index of ``sql/unique_queue.sql`` to reject the
+        duplicates, so it needs PostgreSQL (9.5+) or SQLite. Returns the
+        ``(rule_name, content_type_id, object_id)`` keys of the inserted
+        rows."""
+        using = router.db_for_write(self.model)
+        connection = connections[using]
+        quote_name = connection.ops.quote_name
+        opts = self.model._meta
+        key_columns = ', '.join(
+            quote_name(opts.get_field(name).column)
+            for name in ('rule_name', 'content_type', 'object_id')
+        )
+        into, values, params = self._insert_sql(rows, connection)
+
+        def insert():
+            cursor = connection.cursor()
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    'INSERT ' + into + ', '.join([values] * len(rows))
+                    + ' ON CONFLICT DO NOTHING RETURNING ' + key_columns,
+                    sum(params, []),
+                )
+                return set(cursor.fetchall())
+            if connection.vendor == 'sqlite':
+                inserted = set()
+                for row, row_params in zip(rows, params):
+                    cursor.execute('INSERT OR IGNORE ' + into + values,
+                                   row_params)
+                    if cursor.rowcount:
+                        inserted.add((row.rule_name, row.content_type_id,
+                                      row.object_id))
+                return inserted
+            raise ImproperlyConfigured(
+                'CARRIER_PIGEON_UNIQUE_QUEUE is not supported on %s'
+                % connection.vendor)
+
+        if not rows:
+            return set()
+        inserted = insert()
+        # Like Model.save(): join the transaction of the caller, if any
+        transaction.commit_unless_managed(using=using)
+        return inserted
+
+    def _insert_sql(self, rows, connection):
+        """``INTO table (columns) VALUES`` clause, placeholders of one row
+        and parameters of each row to insert ``rows``."""
+        quote_name = connection.ops.quote_name
+        opts = self.model._meta
+        fields = [f for f in opts.local_fields if not isinstance(f, AutoField)]
+        into = 'INTO %s (%s) VALUES ' % (
+            quote_name(opts.db_table),
+            ', '.join(quote_name(f.column) for f in fields),
+        )
+        values = '(%s)' % ', '.join(['%s'] * len(fields))
+        params = [
+            [f.get_db_prep_save(f.pre_save(row, True), connection=connection)
+             for f in fields]
+            for row in rows
+        ]
+        return into, values, params
+
+    def renew_lease(self, row):
+        """Extend the lease ``row.lease_owner`` holds on ``row``.
+
+        Returns False if the lease was lost meanwhile (expired and reaped),
+        in which case the row must not be processed."""
+        expiration_date = lease_expiration_date()
+        qs = self.get_query_set().filter(
+            pk=row.pk,
+            status=models.ITEM_TO_PUSH_STATUS.IN_PROGRESS,
+            lease_owner=row.lease_owner,
+        )
+        if not qs.update(lease_expiration_date=expiration_date):
+            return False
+        row.lease_expiration_date = expiration_date
+        return True
+
+    def expired_leases(self):
+        """IN_PROGRESS rows whose worker did not finish them in time."""
+        qs = self.get_query_set().in_progress()
+        return qs.filter(lease_expiration_date__lt=datetime.now())
+
+    def reap_expired_leases(self):
+        """Give expired leases back to the queue.
+
+        Rows go back to NEW with one more ``push_attempts``, or to PUSH_ERROR
+        once they reached ``CARRIER_PIGEON_MAX_PUSH_ATTEMPTS`` so that a row
+        killing its workers is not retried forever. Returns the number of
+        reaped rows."""
+        max_ = settings.CARRIER_PIGEON_MAX_PUSH_ATTEMPTS
+        reaped = self.expired_leases().filter(
+            push_attempts__gte=max_ - 1,
+        ).update(
+            status=models.ITEM_TO_PUSH_STATUS.PUSH_ERROR,
+            message=u'Lease expired %s times' % max_,
+            lease_owner=u'',
+            lease_expiration_date=None,
+            push_attempts=F('push_attempts') + 1,
+        )
+        reaped += self.back_to_queue(
+            self.expired_leases(),
+            lease_owner=u'',
+            lease_expiration_date=None,
+            push_attempts=F('push_attempts') + 1,
+        )
+        return reaped
+
+    def back_to_queue(self, qs, **updates):
+        """Flag the rows of ``qs`` NEW again, with ``updates``.
+
+        With ``CARRIER_PIGEON_UNIQUE_QUEUE``, a row whose item was queued
+        again meanwhile would break the unique index: it is merged into its
+        NEW twin instead, which pushes the latest version of the item
+        anyway. Returns the number of rows back in queue, merged ones
+        included."""
+        updates['status'] = models.ITEM_TO_PUSH_STATUS.NEW
+        if not getattr(settings, 'CARRIER_PIGEON_UNIQUE_QUEUE', False):
+            return qs.update(**updates)
+        count = qs.extra(where=[self._no_new_twin_sql()]).update(**updates)
+        for row in qs.exclude(status=models.ITEM_TO_PUSH_STATUS.NEW):
+            # The values it would have been given, F() expressions aside
+            for name in ('push_attempts', 'next_attempt_date'):
+                value = updates.get(name)
+                if value is not None and not isinstance(value, ExpressionNode):
+                    setattr(row, name, value)
+            if self._merge_into_twin(row):
+                count += 1
+        return count
+
+    def _twins(self, row):
+        """NEW rows queued for the same item, rule and url as ``row``."""
+        return self.get_query_set().new().filter(
+            rule_name=row.rule_name,
+            push_url=row.push_url,
+            content_type=row.content_type_id,
+            object_id=row.object_id,
+        ).exclude(pk=row.pk)
+
+    def _merge_into_twin(self, row):
+        """Delete ``row`` in favor of its NEW twin, which inherits its push
+        attempts and next attempt date. Returns False if there is no twin
+        (anymore)."""
+        twins = list(self._twins(row)[:1])
+        if not twins:
+            return False
+        twin = twins[0]
+        next_attempt_date = twin.next_attempt_date
+        if row.next_attempt_date is not None and (
+                next_attempt_date is None
+                or row.next_attempt_date > next_attempt_date):
+            next_attempt_date = row.next_attempt_date
+        self.get_query_set().filter(pk=twin.pk).update(
+            push_attempts=max(twin.push_attempts, row.push_attempts),
+            next_attempt_date=next_attempt_date,
+        )
+        self.get_query_set().filter(pk=row.pk).delete()
+        logger.info(u'row id=%s merged into its twin id=%s'
+                    % (row.pk, twin.pk))
+        return True
+
+    def _no_new_twin_sql(self):
+        """SQL condition: no other NEW row for the same item, rule and url
+        (see ``sql/unique_queue.sql``)."""
+        connection = connections[router.db_for_write(self.model)]
+        quote_name = connection.ops.quote_name
+        opts = self.model._meta
+        table = quote_name(opts.db_table)
+        pk = quote_name(opts.pk.column)
+        conditions = [
+            'twin.%s = %s' % (quote_name(opts.get_field('status').column),
+                              models.ITEM_TO_PUSH_STATUS.NEW),
+            'twin.%s <> %s.%s' % (pk, table, pk),
+        ]
+        for name in ('rule_name', 'push_url', 'content_type', 'object_id'):
+            column = quote_name(opts.get_field(name).column)
+            conditions.append('twin.%s = %s.%s' % (column, table, column))
+        return 'NOT EXISTS (SELECT 1 FROM %s twin WHERE %s)' % (
+            table, ' AND '.join(conditions))
+
+class DestinationManager(django_models.Manager):
+    """Circuit breaker of the push destinations.
+
+    After ``CARRIER_PIGEON_CIRCUIT_BREAKER_THRESHOLD`` consecutive failed
+    deliveries to a host, its circuit opens: nothing is pushed there for
+    ``CARRIER_PIGEON_CIRCUIT_BREAKER_DELAY`` seconds. Then a single worker
+    may try a push (half-open circuit): its success closes the circuit, a
+    failure opens it again, twice as long, up to
+    ``CARRIER_PIGEON_CIRCUIT_BREAKER_MAX_DELAY``. The state lives in the
+    database, so every worker shares it."""
+
+    @property
+    def threshold(self):
+        # Disabled by default
+        return getattr(settings, 'CARRIER_PIGEON_CIRCUIT_BREAKER_THRESHOLD', 0)
+
+    def open_delay(self, failures):
+        """Seconds the circuit stays open after ``failures`` failures."""
+        delay = getattr(settings, 'CARRIER_PIGEON_CIRCUIT_BREAKER_DELAY', 60)
+        max_delay = getattr(settings,
+                            'CARRIER_PIGEON_CIRCUIT_BREAKER_MAX_DELAY', 3600)
+        exponent = min(max(failures - self.threshold, 0), 16)
+        return min(delay * 2 ** exponent, max_delay)
+
+    def blocked_until(self, host):
+        """Date until which nothing should be pushed to ``host``, or None.
+
+        Once an open circuit is due, the first worker asking is let
+        through to try a push while the others keep waiting."""
+        if not self.threshold:
+            return None
+        now = datetime.now()
+        try:
+            destination = self.get(host=host)
+        except self.model.DoesNotExist:
+            return None
+        if destination.open_until is None:
+            return None
+        if destination.open_until > now:
+            return destination.open_until
+        # Half-open: hold the others back while this worker tries
+        trial_until = now + timedelta(
+            seconds=self.open_delay(destination.failures))
+        if self.filter(pk=destination.pk,
+                       open_until=destination.open_until).update(
+                open_until=trial_until):
+            return None
+        return self.get(pk=destination.pk).open_until
+
+    def record_success(self, host):
+        """Close the circuit of ``host``."""
+        if self.threshold:
+            self.filter(host=host, failures__gt=0).update(failures=0,
+                                                          open_until=None)
+
+    def record_failure(self, host):
+        """Count a failed delivery to ``host``, opening its circuit once
+        failures reach the threshold."""
+        if not self.threshold:
+            return
+        destination, created = self.get_or_create(host=host)
+        self.filter(pk=destination.pk).update(failures=F('failures') + 1)
+        failures = self.get(pk=destination.pk).failures
+        if failures >= self.threshold:
+            open_until = datetime.now() + timedelta(
+                seconds=self.open_delay(failures))
+            self.filter(pk=destination.pk).update(open_until=open_until)
+            logger.warning(u'%s failed %s times in a row, circuit open '
+                           u'until %s' % (host, failures, open_until))
+
+
+class DeliveredFileManager(django_models.Manager):
+    """Manifest of the files delivered to each destination."""
+
+    # Keep below the query parameters limit of SQLite
+    chunk_size = 500
+
+    def unchanged(self, destination, manifest):
+        """Paths of ``manifest`` delivered to ``destination`` with the same
+        size and digest.
+
+        ``manifest`` maps paths to ``(size, digest)``, see
+        ``utils.TreeHash.manifest``."""
+        paths = manifest.keys()
+        unchanged = set()
+        for i in xrange(0, len(paths), self.chunk_size):
+            delivered = self.filter(
+                destination=destination,
+                path__in=paths[i:i + self.chunk_size],
+            ).values_list('path', 'size', 'digest')
+            unchanged.update(path for path, size, digest in delivered
+                             if manifest[path] == (size, digest))
+        return unchanged
+
+    def record(self, destination, manifest):
+        """Remember the files of ``manifest`` as delivered."""
+        for path, (size, digest) in manifest.iteritems():
+            delivered, created = self.get_or_create(
+                destination=destination, path=path,
+                defaults={'size': size, 'digest': digest},
+            )
+            if not created:
+                self.filter(pk=delivered.pk).update(
+                    size=size, digest=digest, delivery_date=datetime.now())
+
+
 def add_filters():
     """Add filters for every choice in ItemToPush.STATUS.
 
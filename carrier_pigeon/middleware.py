@@ -0,0 +1,32 @@
+from carrier_pigeon.select import _buffer
+from carrier_pigeon.select import flush_selection
+
+
+class DeferredSelectionMiddleware(object):
+    """
+    Select the objects saved during a request once, when it is over.
+
+    Put it *before* ``django.middleware.transaction.TransactionMiddleware``
+    so that the selection happens after the request transaction is
+    committed.
+    """
+
+    def process_request(self, request):
+        _buffer.depth += 1
+
+    def process_exception(self, request, exception):
+        self._leave()
+        _buffer.clear()
+
+    def process_response(self, request, response):
+        if self._leave():
+            flush_selection()
+        return response
+
+    def _leave(self):
+        """Returns True when leaving the outermost deferred block."""
+        if not _buffer.depth:
+            # Already left in process_exception
+            return False
+        _buffer.depth -= 1
+        return not _buffer.depth
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
@@ -63,6 +64,11 @@ class ItemToPush(models.Model):
     status = models.PositiveIntegerField(choices=STATUS.CHOICES,
                                          default=STATUS.NEW)
     message = models.TextField()
+    # Worker currently processing this row (see ``ItemToPush.objects.claim``)
+    lease_owner = models.CharField(max_length=100, blank=True, default=u'')
+    lease_expiration_date = models.DateTimeField(null=True, blank=True)
+    # Failed pushes may be retried later, not before this date
+    next_attempt_date = models.DateTimeField(null=True, blank=True)
     
     # Item to push
     content_type = models.ForeignKey(ContentType)
@@ -82,7 +88,63 @@ class ItemToPush(models.Model):
         Change this is item as a new.
         The item will be processed again.
         """
+        self._back_to_queue(message=u"", next_attempt_date=None)
+
+    def postpone(self, next_attempt_date):
+        """
+        Give this item back to the queue, not to be pushed before
+        `next_attempt_date`.
+        """
+        self._back_to_queue(message=self.message,
+                            push_attempts=self.push_attempts,
+                            next_attempt_date=next_attempt_date)
+
+    def _back_to_queue(self, **fields):
+        # See ItemToPush.objects.back_to_queue
+        fields.update(lease_owner=u"", lease_expiration_date=None)
+        for name, value in fields.iteritems():
+            setattr(self, name, value)
         self.status = self.STATUS.NEW
-        self.message = u""
-        self.save()
+        if not getattr(settings, 'CARRIER_PIGEON_UNIQUE_QUEUE', False):
+            self.save()
+            return
+        ItemToPush.objects.back_to_queue(
+            ItemToPush.objects.filter(pk=self.pk), **fields)
+
 
+class Destination(models.Model):
+    """Health of a push destination, shared by the push workers."""
+
+    host = models.CharField(max_length=255, unique=True)
+    # Consecutive failed deliveries
+    failures = models.PositiveIntegerField(default=0)
+    # The circuit is open, nothing is pushed to this host before this date
+    open_until = models.DateTimeField(null=True, blank=True)
+
+    # Managers
+    objects = managers.DestinationManager()
+
+    def __unicode__(self):
+        return self.host
+
+
+
+class DeliveredFile(models.Model):
+    """Last version of a file delivered to a destination."""
+
+    # Push url, without its options
+    destination = models.CharField(max_length=300)
+    # Relative to the configuration outbox, as listed by ``utils.TreeHash``
+    path = models.CharField(max_length=300)
+    size = models.BigIntegerField()
+    digest = models.CharField(max_length=64)
+    delivery_date = models.DateTimeField(auto_now=True)
+
+    # Managers
+    objects = managers.DeliveredFileManager()
+
+    class Meta:
+        unique_together = ('destination', 'path')
+
+    def __unicode__(self):
+        return u'%s %s' % (self.destination, self.path)
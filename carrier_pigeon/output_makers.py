@@ -49,6 +49,19 @@ class BaseOutputMaker(object):
         """
         raise NotImplementedError("Must be implemented.")
 
+    def archive(self, archive, output):
+        """
+        Store the final file in `archive` (a utils.ZipArchive) instead of
+        the working dir, see ZIPPacker.
+
+        Output makers able to write directly into the archive override this.
+        """
+        if not os.path.exists(self.local_final_directory):
+            os.makedirs(self.local_final_directory)
+        local_final_path = self.release(output)
+        archive.write(local_final_path, self.relative_final_path)
+        os.remove(local_final_path)
+
     @property
     def local_final_path(self):
         """
@@ -142,6 +155,10 @@ class TemplateOutputMaker(BaseOutputMaker):
         f.close()
         return self.local_final_path
 
+    def archive(self, archive, output):
+        """ Write the XML content in `archive`. """
+        archive.writestr(self.relative_final_path, output)
+
 
 class BinaryOutputMaker(BaseOutputMaker):
 
@@ -176,3 +193,7 @@ class BinaryOutputMaker(BaseOutputMaker):
         """
         shutil.copy(output, self.local_final_path)
         return self.local_final_path
+
+    def archive(self, archive, output):
+        """ Copy the original file in `archive`. """
+        archive.write(output, self.relative_final_path)
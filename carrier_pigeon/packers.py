@@ -8,6 +8,9 @@ import os
 import shutil
 import logging
 
+from django.conf import settings
+
+from carrier_pigeon.utils import ZipArchive
 from carrier_pigeon.utils import zipdir
 
 logger = logging.getLogger('carrier_pigeon.packer')
@@ -53,8 +56,15 @@ class FlatPacker(BasePacker):
 class ZIPPacker(BasePacker):
     """
     Pack outputed files in a ZIP.
+
+    The configuration opens the archive when the push is initialized and the
+    output makers write straight into it, see `add`; no file is written to
+    the tmp directory. Set `streaming` to False to zip the tmp directory
+    once all the files are there instead.
     """
 
+    streaming = True
+
     @property
     def archive_name(self):
         if hasattr(self.configuration, "archive_name"):
@@ -62,6 +72,55 @@ class ZIPPacker(BasePacker):
         else:
             return "%s.zip" % self.configuration.name
 
+    @property
+    def compression_level(self):
+        """ Deflate level (0-9) of the entries not compressed already. """
+        if hasattr(self.configuration, "zip_compression_level"):
+            return self.configuration.zip_compression_level
+        return getattr(settings, 'CARRIER_PIGEON_ZIP_COMPRESSION_LEVEL', None)
+
+    @property
+    def compression_threads(self):
+        """ Number of entries compressed at the same time. """
+        if hasattr(self.configuration, "zip_compression_threads"):
+            return self.configuration.zip_compression_threads
+        return getattr(settings, 'CARRIER_PIGEON_ZIP_COMPRESSION_THREADS', 1)
+
+    @property
+    def zipname(self):
+        return os.path.join(
+            self.configuration.outbox_directory,
+            self.archive_name
+        )
+
+    def open(self):
+        """ Start streaming the archive. """
+        if not os.path.exists(self.configuration.outbox_directory):
+            os.makedirs(self.configuration.outbox_directory)
+        # archive_name may change at each call
+        self._zipname = self.zipname
+        logging.debug("open(): zipname: %s" % self._zipname)
+        self._archive = ZipArchive(self._zipname, self.compression_level,
+                                   self.compression_threads)
+        self._names = set()
+
+    def add(self, output_maker, output):
+        """
+        Write the output of `output_maker` in the archive. Returns its name
+        in the archive.
+        """
+        name = output_maker.relative_final_path
+        # Items sharing a related item output it several times
+        if name not in self._names:
+            output_maker.archive(self._archive, output)
+            self._names.add(name)
+        return name
+
+    def close(self):
+        """ Finish the streamed archive. """
+        self._archive.close()
+        return [self._zipname]
+
     def pack(self):
         """ Pack files into ZIP archive. """
 
@@ -71,14 +130,12 @@ class ZIPPacker(BasePacker):
         if not os.path.exists(self.configuration.outbox_directory):
             os.makedirs(self.configuration.outbox_directory)
 
-        zipname = os.path.join(
-            self.configuration.outbox_directory,
-            self.archive_name
-        )
+        zipname = self.zipname
         logging.debug("pack(): zipname: %s" % zipname)
 
         try:
-            zipdir(dirname, zipname)
+            zipdir(dirname, zipname, self.compression_level,
+                   self.compression_threads)
         except IOError:
             logging.error(u"pack(): Cannot create archive '%s' in directory '%s'" \
                 % (zipname, dirname))
@@ -4,11 +4,21 @@ import logging
 
 from django.conf import settings
 
+from carrier_pigeon.configuration import SequentialPusherConfiguration
 from carrier_pigeon.utils import get_instance
 
 
 REGISTRY = {}
 
+# Sequential rules by model they handle, see ``sequential_rules_for_model``
+SEQUENTIAL_RULES_BY_MODEL = {}
+# Sequential rules that do not declare the models they handle
+SEQUENTIAL_RULES_FOR_ANY_MODEL = []
+# ``sequential_rules_for_model`` results
+_RULES_FOR_MODEL_CACHE = {}
+# REGISTRY contents the above were built from
+_INDEXED_REGISTRY = {}
+
 
 def add_instance(instance, clazz_path=None):
     global REGISTRY
@@ -19,6 +29,52 @@ def add_instance(instance, clazz_path=None):
     logger.debug(msg)
 
 
+def index_registry():
+    """
+    Route the models handled by the sequential rules of REGISTRY to them.
+
+    Done again whenever REGISTRY changed since, so rules set or removed
+    there directly are taken into account too.
+    """
+    global SEQUENTIAL_RULES_BY_MODEL, SEQUENTIAL_RULES_FOR_ANY_MODEL
+    global _RULES_FOR_MODEL_CACHE, _INDEXED_REGISTRY
+    if REGISTRY == _INDEXED_REGISTRY:
+        return
+    registry = dict(REGISTRY)
+    by_model = {}
+    for_any_model = []
+    for name in sorted(registry):
+        instance = registry[name]
+        if not isinstance(instance, SequentialPusherConfiguration):
+            continue
+        if instance.handled_models is None:
+            for_any_model.append(instance)
+        else:
+            for model in instance.handled_models:
+                by_model.setdefault(model, []).append(instance)
+    # Swapped rather than updated, for the threads reading them
+    SEQUENTIAL_RULES_BY_MODEL = by_model
+    SEQUENTIAL_RULES_FOR_ANY_MODEL = for_any_model
+    _RULES_FOR_MODEL_CACHE = {}
+    _INDEXED_REGISTRY = registry
+
+
+def sequential_rules_for_model(model):
+    """Returns the sequential rules that may select instances of ``model``."""
+    index_registry()
+    cache = _RULES_FOR_MODEL_CACHE
+    try:
+        return list(cache[model])
+    except KeyError:
+        rules = list(SEQUENTIAL_RULES_FOR_ANY_MODEL)
+        # Rules handling a parent model handle its children too
+        for clazz in model.mro():
+            rules += [rule for rule in SEQUENTIAL_RULES_BY_MODEL.get(clazz, [])
+                      if rule not in rules]
+        cache[model] = rules
+        return list(rules)
+
+
 def register_config(clazz_path):
     instance = get_instance(clazz_path)
     add_instance(instance, clazz_path)
@@ -1,13 +1,86 @@
 import logging
+import threading
+from contextlib import contextmanager
 
 from carrier_pigeon.models import ItemToPush
-from carrier_pigeon.facility import add_item_to_push
-from carrier_pigeon.configuration import SequentialPusherConfiguration
+from carrier_pigeon.facility import add_items_to_push
 
 
 logger = logging.getLogger('carrier_pigeon.select')
 
 
+class SelectionBuffer(threading.local):
+    """Saves recorded by ``select`` inside ``deferred_selection`` blocks."""
+
+    def __init__(self):
+        self.depth = 0
+        self.clear()
+
+    def clear(self):
+        self.keys = []  # keep the order of the first saves
+        self.saves = {}
+
+    def record(self, instance, created):
+        """Merge this save with the previous ones of the same object."""
+        key = (instance.__class__, instance.pk)
+        modified_attrs = getattr(instance, '_modified_attrs', None) or []
+        if key in self.saves:
+            _, was_created, attrs = self.saves[key]
+            created = created or was_created
+            modified_attrs = attrs + [a for a in modified_attrs
+                                      if a not in attrs]
+        else:
+            self.keys.append(key)
+        self.saves[key] = (instance, created, list(modified_attrs))
+
+    def pop_all(self):
+        saves = [self.saves[key] for key in self.keys]
+        self.clear()
+        return saves
+
+
+_buffer = SelectionBuffer()
+
+
+@contextmanager
+def deferred_selection():
+    """Defer the selection of the objects saved in this block to its end.
+
+    Each object is then evaluated once, whatever the number of times it was
+    saved, and all the selected items are added to the queue at once. Nothing
+    is selected if an exception is raised in the block."""
+    _buffer.depth += 1
+    try:
+        yield
+    except:
+        _buffer.depth -= 1
+        if not _buffer.depth:
+            _buffer.clear()
+        raise
+    _buffer.depth -= 1
+    if not _buffer.depth:
+        flush_selection()
+
+
+def flush_selection():
+    """Select the saves recorded by ``deferred_selection``."""
+    items = []
+    for instance, created, modified_attrs in _buffer.pop_all():
+        # Let the supervisors see the fields modified by all the saves, but
+        # not the next save of the instance
+        previous = instance.__dict__.get('_modified_attrs')
+        instance.__dict__['_modified_attrs'] = modified_attrs
+        try:
+            items += [(instance, rule_name)
+                      for rule_name in selected_rules(instance, created)]
+        finally:
+            if previous is None:
+                instance.__dict__.pop('_modified_attrs', None)
+            else:
+                instance.__dict__['_modified_attrs'] = previous
+    add_items_to_push(items)
+
+
 def filter(rule_name, model_supervisor, instance, created):
     """Returns True if the rule model_supervisor validates
     this instance, False otherwise."""
@@ -63,18 +136,15 @@ def filter(rule_name, model_supervisor, instance, created):
     return True
 
 
-def select(sender, instance=None, created=False, **kwargs):
-    """Add instance to ItemToPush queue for each partner that
-    validated the instance."""
-    logger.debug(u'post_save caught for %s?pk=%s' %
-                 (instance._meta.object_name, instance.pk))
+def selected_rules(instance, created):
+    """Returns the names of the sequential rules validating this instance."""
 
-    from carrier_pigeon.registry import REGISTRY
+    from carrier_pigeon.registry import sequential_rules_for_model
 
-    for rule_name, configuration in REGISTRY.iteritems():
-        if not SequentialPusherConfiguration in configuration.__class__.mro():
-            # Only the sequential configurations are concerned here
-            continue
+    rule_names = []
+    # Only the sequential configurations are concerned here
+    for configuration in sequential_rules_for_model(instance.__class__):
+        rule_name = configuration.name
         logger.debug('selecting Item for `%s` rule' % rule_name)
         # if instance doesn't match configuration
         # try another rule_name
@@ -86,7 +156,22 @@ def select(sender, instance=None, created=False, **kwargs):
         if (not model_supervisor
             or not filter(rule_name, model_supervisor, instance, created)):
             continue
+        rule_names.append(rule_name)
+    return rule_names
+
+
+def select(sender, instance=None, created=False, **kwargs):
+    """Add instance to ItemToPush queue for each partner that
+    validated the instance."""
+    logger.debug(u'post_save caught for %s?pk=%s' %
+                 (instance._meta.object_name, instance.pk))
+
+    if _buffer.depth:
+        _buffer.record(instance, created)
+        logger.debug('selection deferred')
+        return
 
-        # try to create a row for each push_url
-        add_item_to_push(instance, rule_name)
+    # try to create a row for each push_url of each rule, at once
+    add_items_to_push([(instance, rule_name)
+                       for rule_name in selected_rules(instance, created)])
     logger.debug('end of select')
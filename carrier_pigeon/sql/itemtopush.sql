@@ -0,0 +1,10 @@
+-- Run by syncdb once the carrier_pigeon_itemtopush table is created.
+-- See the "Upgrading" section of the README for existing databases.
+
+-- Push queue: rows by status, oldest first (ItemToPush.objects.claim)
+CREATE INDEX carrier_pigeon_itemtopush_status_creation_date
+    ON carrier_pigeon_itemtopush (status, creation_date);
+
+-- Duplicates lookup on enqueue (facility.queued_keys)
+CREATE INDEX carrier_pigeon_itemtopush_content_object_rule_status
+    ON carrier_pigeon_itemtopush (content_type_id, object_id, rule_name, status);
@@ -0,0 +1,7 @@
+-- Optional, see CARRIER_PIGEON_UNIQUE_QUEUE in the README.
+-- Needs partial indexes: PostgreSQL or SQLite.
+
+-- An item waits only once in the queue for each rule and url
+CREATE UNIQUE INDEX carrier_pigeon_itemtopush_unique_new
+    ON carrier_pigeon_itemtopush (rule_name, push_url, content_type_id, object_id)
+    WHERE status = 10;
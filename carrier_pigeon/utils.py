@@ -1,18 +1,23 @@
 # -*- coding:utf-8 -*-
 
 import os
+import time
 import pickle
+import zlib
 import hashlib
 import logging
+import threading
 
+from collections import OrderedDict
+from collections import deque
 from contextlib import closing
-from urlparse import urlparse
-from zipfile import ZipFile, ZIP_DEFLATED
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse, parse_qsl
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT
 
+from django.conf import settings
 from django.db.models import fields
 
-from carrier_pigeon.models import ItemToPush
-
 
 logger = logging.getLogger('carrier_pigeon.utils')
 
@@ -29,6 +34,8 @@ class URL:
         self.params = parsed.params
         self.query = parsed.query
         self.fragment = parsed.fragment
+        # Delivery options, given in the query string
+        self.options = dict(parse_qsl(parsed.query))
 
         if '@' in parsed.netloc:
             login_password, self.domain = parsed.netloc.split('@')
@@ -43,34 +50,124 @@ class URL:
             self.port = None
 
 
+class CRC32(object):
+    """ hashlib-like zlib.crc32, much faster than cryptographic digests. """
+
+    block_size = 64
+
+    def __init__(self, data=''):
+        self._crc = 0
+        self.update(data)
+
+    def update(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+
+    def hexdigest(self):
+        return '%08x' % (self._crc & 0xffffffff)
+
+
+def get_hasher(algorithm):
+    """ Constructor of the `algorithm` digests: crc32 or a hashlib name. """
+    if algorithm == 'crc32':
+        return CRC32
+    hashlib.new(algorithm)  # raises ValueError if not supported
+    return lambda data='': hashlib.new(algorithm, data)
+
+
+class HashCache(object):
+    """ Bounded cache of file hashes.
+
+    Entries are keyed by path, size, mtime and inode, so a file changed or
+    replaced since it was hashed is hashed again. """
+
+    def __init__(self, size):
+        self.size = size
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, fn, algorithm):
+        stat = os.stat(fn)
+        return (fn, stat.st_size, stat.st_mtime, stat.st_ino, algorithm)
+
+    def get(self, key):
+        with self._lock:
+            return self._hashes.get(key)
+
+    def set(self, key, digest):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._hashes.pop(key, None)
+            self._hashes[key] = digest
+            while len(self._hashes) > self.size:
+                self._hashes.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._hashes.clear()
+
+
+HASH_CACHE = HashCache(
+    getattr(settings, 'CARRIER_PIGEON_HASH_CACHE_SIZE', 100000))
+
+
 class TreeHash:
     """ Allow to compute a validation hash for a whole directory tree.
-    Used in local vs. remote testing. """
+    Used in local vs. remote testing.
+
+    Files are hashed by `threads` at a time with `algorithm` (sha1 by
+    default, see get_hasher), their hashes are kept in HASH_CACHE. """
 
-    def __init__(self, local_root):
+    def __init__(self, local_root, algorithm=None, threads=None):
         self._local_root = local_root
         self._files = list()
-        self._hasher = hashlib.sha1
+        self._algorithm = algorithm or getattr(
+            settings, 'CARRIER_PIGEON_HASH_ALGORITHM', 'sha1')
+        self._hasher = get_hasher(self._algorithm)
+        self._threads = threads or getattr(
+            settings, 'CARRIER_PIGEON_HASH_THREADS', 4)
         self._hash = ''
 
     def hash_file(self, fn):
+        key = HASH_CACHE.key(fn, self._algorithm)
+        digest = HASH_CACHE.get(key)
+        if digest is not None:
+            return digest
         hasher = self._hasher()
         with open(fn,'rb') as f: 
             for chunk in iter(lambda: f.read(128*hasher.block_size), ''): 
                  hasher.update(chunk)
-        return hasher.hexdigest()
+        digest = hasher.hexdigest()
+        HASH_CACHE.set(key, digest)
+        return digest
+
+    def relative_name(self, fn_full):
+        return fn_full.replace(self._local_root, '.')
+
+    def file_entry(self, fn_full):
+        return (
+            self.relative_name(fn_full), # file name, rel. to local root
+            os.stat(fn_full).st_size,    # file size, in bytes
+            self.hash_file(fn_full),     # file hash
+        )
+
+    def file_entries(self, file_names):
+        """ file_entry() of each file, hashed in parallel. """
+        if self._threads <= 1 or len(file_names) <= 1:
+            return map(self.file_entry, file_names)
+        pool = ThreadPool(min(self._threads, len(file_names)))
+        try:
+            return pool.map(self.file_entry, file_names, chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
 
     def list_files(self):
-        self._files = list()
+        file_names = list()
         for root, dirs, files in os.walk(self._local_root, topdown=True):
             for f in files:
-                fn_full = os.path.join(root, f)
-                fn_rel = fn_full.replace(self._local_root, '.')
-                self._files.append((
-                    fn_rel,                   # file name, rel. to local root
-                    os.stat(fn_full).st_size, # file size, in bytes
-                    self.hash_file(fn_full),  # file hash
-                ))
+                file_names.append(os.path.join(root, f))
+        self._files = self.file_entries(file_names)
 
         #logging.debug(u"TreeHash.list_files(): %s" % str(self._files))
 
@@ -86,6 +183,11 @@ class TreeHash:
     def hash(self):
         return self._hash or self.compute()
 
+    def manifest(self, file_names):
+        """ Size and hash of the files `file_names`, by relative name. """
+        return dict((fn_rel, (size, digest)) for fn_rel, size, digest
+                    in self.file_entries(file_names))
+
 
 def join_url_to_directory(url, directory):
     ends_with = url.endswith('/')
@@ -104,22 +206,41 @@ def join_url_to_directory(url, directory):
     raise Exception('Unhandled case')
 
 
-def duplicate_row(rule_name, instance):
-    """Checks if there is already is a row like this one."""
-    app_label = instance._meta.app_label
-    model = instance._meta.module_name
-    name = instance._meta.verbose_name
-    id = instance.id
+class RecentKeys(object):
+    """ Bounded set of recently seen keys.
 
-    query = ItemToPush.objects.filter(rule_name=rule_name,
-                                      status=ItemToPush.STATUS.NEW,
-                                      content_type__app_label=app_label,
-                                      content_type__model=model,
-                                      content_type__name=name,
-                                      object_id=id)
-    count = query.count()
+    Keys are forgotten after ``timeout`` seconds, or sooner when more than
+    ``size`` keys were added since (least recently seen first). """
 
-    return count > 0
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            try:
+                seen = self._keys.pop(key)
+            except KeyError:
+                return False
+            if time.time() - seen > self.timeout:
+                return False
+            self._keys[key] = seen  # most recently seen now
+            return True
+
+    def add(self, key):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._keys.pop(key, None)
+            self._keys[key] = time.time()
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
 
 
 def get_instance(clazz_module):
@@ -146,17 +267,214 @@ def related_objects(instance, field):
 
 
 # From: http://coreygoldberg.blogspot.com/2009/07/python-zip-directories-recursively.html
-def zipdir(dir, zip_file):
+# Formats compressed already, deflating them again only wastes time
+STORED_EXTENSIONS = frozenset([
+    '.jpg', '.jpeg', '.png', '.gif', '.webp',
+    '.mp3', '.ogg', '.mp4', '.m4a', '.m4v', '.mov', '.webm', '.flv',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar',
+])
+
+MAGIC_NUMBERS = (
+    '\xff\xd8\xff',       # JPEG
+    '\x89PNG',            # PNG
+    'GIF8',               # GIF
+    'PK\x03\x04',         # ZIP
+    '\x1f\x8b',           # gzip
+    'BZh',                # bzip2
+    '\xfd7zXZ',           # xz
+    'OggS',               # Ogg
+    'ID3',                # MP3
+)
+
+# Bytes of each entry used to guess how to compress it
+PROBE_SIZE = 64 * 1024
+
+# Files up to this size are read whole and compressed by the thread pool,
+# bigger ones are deflated in chunks of CHUNK_SIZE by the writing thread
+PARALLEL_MAX_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+def zip_compress_type(name, head):
+    """
+    ZIP_STORED if the entry `name`, starting with `head`, looks compressed
+    already, ZIP_DEFLATED otherwise.
+
+    The extension is checked first, then the magic number; other entries
+    are stored if deflating their `head` saves less than 10%.
+    """
+    if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+        return ZIP_STORED
+    if head.startswith(MAGIC_NUMBERS) or head[4:8] == 'ftyp':  # ftyp: MP4
+        return ZIP_STORED
+    if len(head) > 1024 and len(zlib.compress(head, 1)) > 0.9 * len(head):
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+class ZipArchive(object):
+    """
+    ZipFile choosing the compression of each entry: data compressed already
+    is stored, the rest deflated at `level` (zlib's default if None).
+
+    With `threads` > 1, entries are compressed by a thread pool (zlib
+    releases the GIL) while the archive is written, in the order they were
+    added. Files bigger than PARALLEL_MAX_SIZE are deflated in chunks
+    instead, so that they are never held in memory.
+    """
+
+    def __init__(self, file_name, level=None, threads=1):
+        self.zip = ZipFile(file_name, 'w', ZIP_DEFLATED, allowZip64=True)
+        self.level = level
+        self._pool = ThreadPool(threads) if threads > 1 else None
+        # Entries being compressed, bounded to keep memory in check
+        self._pending = deque()
+        self._max_pending = threads * 4
+
+    def writestr(self, name, data):
+        """ Write the string `data` as `name`. """
+        zinfo = ZipInfo(name, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0600 << 16
+        zinfo.compress_type = zip_compress_type(name, data[:PROBE_SIZE])
+        self._write(zinfo, data)
+
+    def write(self, file_path, name):
+        """ Write the file `file_path` as `name`. """
+        with open(file_path, 'rb') as f:
+            compress_type = zip_compress_type(name, f.read(PROBE_SIZE))
+        if compress_type == ZIP_STORED or (self.level is None and
+                                           self._pool is None):
+            # ZipFile streams the file
+            self.flush()
+            self.zip.write(file_path, name, compress_type)
+            return
+        zinfo = self._zinfo(file_path, name)
+        zinfo.compress_type = compress_type
+        if (self._pool is not None and
+                os.path.getsize(file_path) <= PARALLEL_MAX_SIZE):
+            with open(file_path, 'rb') as f:
+                self._write(zinfo, f.read())
+            return
+        self.flush()
+        self._write_file(zinfo, file_path)
+
+    def _zinfo(self, file_path, name):
+        # Same as ZipFile.write
+        st = os.stat(file_path)
+        zinfo = ZipInfo(name, time.localtime(st.st_mtime)[:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+        return zinfo
+
+    def _write(self, zinfo, data):
+        if self._pool is not None:
+            self._pending.append(
+                self._pool.apply_async(self._compress, (zinfo, data)))
+            while len(self._pending) > self._max_pending:
+                self._write_next()
+            return
+        if zinfo.compress_type == ZIP_STORED or self.level is None:
+            self.zip.writestr(zinfo, data)
+            return
+        self._write_compressed(*self._compress(zinfo, data))
+
+    def _compress(self, zinfo, data):
+        """ Fill the sizes and CRC of `zinfo`, returns it and its data. """
+        zinfo.file_size = len(data)
+        zinfo.CRC = zlib.crc32(data) & 0xffffffff
+        if zinfo.compress_type == ZIP_DEFLATED:
+            level = self.level
+            if level is None:
+                level = zlib.Z_DEFAULT_COMPRESSION
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush()
+        zinfo.compress_size = len(data)
+        return zinfo, data
+
+    def _write_file(self, zinfo, file_path):
+        # ZipFile.write, deflating at self.level
+        zip_ = self.zip
+        zinfo.file_size = os.path.getsize(file_path)
+        zinfo.CRC = zinfo.compress_size = 0
+        zinfo.header_offset = zip_.fp.tell()
+        zip_._writecheck(zinfo)
+        zip_._didModify = True
+        zip64 = zinfo.file_size * 1.05 > ZIP64_LIMIT
+        zip_.fp.write(zinfo.FileHeader(zip64))
+        level = self.level
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        crc = file_size = compress_size = 0
+        with open(file_path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                file_size += len(chunk)
+                crc = zlib.crc32(chunk, crc) & 0xffffffff
+                chunk = compressor.compress(chunk)
+                compress_size += len(chunk)
+                zip_.fp.write(chunk)
+        chunk = compressor.flush()
+        compress_size += len(chunk)
+        zip_.fp.write(chunk)
+        if not zip64 and max(file_size, compress_size) > ZIP64_LIMIT:
+            raise RuntimeError('File size has increased during compressing')
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        zinfo.CRC = crc
+        # Rewrite the header with the sizes and CRC
+        position = zip_.fp.tell()
+        zip_.fp.seek(zinfo.header_offset)
+        zip_.fp.write(zinfo.FileHeader(zip64))
+        zip_.fp.seek(position)
+        zip_.filelist.append(zinfo)
+        zip_.NameToInfo[zinfo.filename] = zinfo
+
+    def _write_next(self):
+        self._write_compressed(*self._pending.popleft().get())
+
+    def _write_compressed(self, zinfo, data):
+        # ZipFile.writestr, minus the compression which can't be tuned
+        zip_ = self.zip
+        zinfo.header_offset = zip_.fp.tell()
+        zip_._writecheck(zinfo)
+        zip_._didModify = True
+        zip64 = (zinfo.file_size > ZIP64_LIMIT or
+                 zinfo.compress_size > ZIP64_LIMIT)
+        zip_.fp.write(zinfo.FileHeader(zip64))
+        zip_.fp.write(data)
+        zip_.fp.flush()
+        zip_.filelist.append(zinfo)
+        zip_.NameToInfo[zinfo.filename] = zinfo
+
+    def flush(self):
+        """ Write the entries being compressed. """
+        while self._pending:
+            self._write_next()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+            self.zip.close()
+
+
+def zipdir(dir, zip_file, level=None, threads=1):
     """
     dir = directory where to get files to zip
     zip_file = path to the zip file to generate
+    level, threads = see ZipArchive
     """
-    zip_ = ZipFile(zip_file, 'w', compression=ZIP_DEFLATED)
+    zip_ = ZipArchive(zip_file, level, threads)
     root_len = len(os.path.abspath(dir))
     for root, dirs, files in os.walk(dir):
         archive_root = os.path.abspath(root)[root_len:]
         for f in files:
             fullpath = os.path.join(root, f)
-            archive_name = os.path.join(archive_root, f)
-            zip_.write(fullpath, archive_name, ZIP_DEFLATED)
+            archive_name = os.path.join(archive_root, f).lstrip('/')
+            zip_.write(fullpath, archive_name)
     zip_.close()
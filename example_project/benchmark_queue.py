@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Times the push queue poll and the duplicates lookup while the ItemToPush
+table grows, with and without the indexes of carrier_pigeon/sql/itemtopush.sql.
+
+Usage, from this directory:
+
+    python benchmark_queue.py [rows ...]
+
+Rows default to 100000 1000000 10000000. A throwaway SQLite database is
+built in the temporary directory; 99.99% of its rows are PUSHED, as in a
+queue that has been running for a while.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from datetime import datetime
+from datetime import timedelta
+from itertools import islice
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
+
+from django.conf import settings
+
+DATABASE = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+# Before django.db reads them
+settings.DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': DATABASE,
+    }
+}
+settings.DEBUG = False  # don't log the queries
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import connection
+from django.db import transaction
+
+from carrier_pigeon.facility import queued_keys
+from carrier_pigeon.models import ItemToPush
+
+
+SQL_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'carrier_pigeon', 'sql', 'itemtopush.sql')
+RULES = ['rule%s' % i for i in range(5)]
+NEW_EVERY = 10000  # 0.01% of NEW rows
+RUNS = 20
+
+
+def index_statements():
+    lines = [line for line in open(SQL_FILE)
+             if not line.strip().startswith('--')]
+    return [sql.strip() for sql in ''.join(lines).split(';') if sql.strip()]
+
+
+def index_names():
+    return [sql.split()[2] for sql in index_statements()]
+
+
+def fill(start, stop, content_type):
+    """ Insert the rows `start` to `stop`, bypassing the ORM for speed. """
+    fields = [f for f in ItemToPush._meta.local_fields
+              if f.column != 'id']
+    columns = [f.column for f in fields]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        ItemToPush._meta.db_table, ', '.join(columns),
+        ', '.join(['%s'] * len(columns)))
+    base = datetime(2012, 1, 1)
+
+    def rows():
+        for i in xrange(start, stop):
+            row = {
+                'rule_name': RULES[i % len(RULES)],
+                'push_url': 'ftp://ftp.example.com/',
+                'creation_date': str(base + timedelta(seconds=i)),
+                'last_push_attempts_date': None,
+                'push_attempts': 1,
+                'status': (ItemToPush.STATUS.NEW if i % NEW_EVERY == 0
+                           else ItemToPush.STATUS.PUSHED),
+                'message': '',
+                'lease_owner': '',
+                'lease_expiration_date': None,
+                'next_attempt_date': None,
+                'content_type_id': content_type.pk,
+                'object_id': i,
+            }
+            yield [row[column] for column in columns]
+
+    cursor = connection.cursor()
+    rows = rows()
+    while True:
+        batch = list(islice(rows, 100000))
+        if not batch:
+            break
+        cursor.executemany(sql, batch)
+    transaction.commit_unless_managed()
+
+
+def best_time(function):
+    """ Fastest of RUNS calls of `function`, in ms. """
+    times = []
+    for i in range(RUNS):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times) * 1000
+
+
+def measure(size, content_type):
+    """ Poll plus duplicates lookup, as done by pigeon_push and on save. """
+    keys = [(RULES[i % len(RULES)], content_type.pk, i)
+            for i in range(0, size, size // 10)]
+
+    def poll_and_lookup():
+        list(ItemToPush.objects.claimable().values_list('pk', flat=True)[:10])
+        queued_keys(keys)
+    return best_time(poll_and_lookup)
+
+
+def main(sizes):
+    call_command('syncdb', interactive=False, verbosity=0)
+    content_type = ContentType.objects.get_for_model(User)
+    cursor = connection.cursor()
+    print '%10s %12s %12s' % ('rows', 'no index', 'indexed')
+    count = 0
+    for size in sizes:
+        for name in index_names():
+            cursor.execute('DROP INDEX IF EXISTS %s' % name)
+        fill(count, size, content_type)
+        count = size
+        without = measure(size, content_type)
+        for sql in index_statements():
+            cursor.execute(sql)
+        transaction.commit_unless_managed()
+        print '%10s %9.3f ms %9.3f ms' % (size, without,
+                                          measure(size, content_type))
+        sys.stdout.flush()
+    shutil.rmtree(os.path.dirname(DATABASE))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [100000, 1000000, 10000000])
@@ -93,6 +93,7 @@ class BelovedPartner(SequentialPusherConfiguration):
     """
 
     packer = FlatPacker
+    handled_models = (Story, Photo)
 
     def get_supervisor_for_item(self, item):
         if item.__class__ == Story:
@@ -7,11 +7,14 @@ from datetime import date
 from datetime import datetime
 from datetime import timedelta
 
+from mock import patch
+
 from django.conf import settings
 from django.core.files import File
 from django.core.management import call_command
 
 from carrier_pigeon.models import ItemToPush
+from carrier_pigeon.registry import REGISTRY
 
 from example_app.models import Photo
 from example_app.models import Story
@@ -125,3 +128,14 @@ class WeeklyDigestTests(ImplementationBaseTests):
         zzz = zipfile.ZipFile(path)
         zzz.extractall(self.outbox)
         self._test_content()
+
+    def test_pigeon_push_streaming(self):
+        rule = REGISTRY[self.tested_configuration_name]
+        with patch.object(rule.__class__, 'cleanup'):
+            call_command('pigeon_mass_push', 'weeklydigest')
+        # Output makers wrote straight into the archive
+        self.assertFalse(os.path.exists(rule.tmp_directory))
+        path = os.path.join(self.outbox, 'weeklydigest.zip')
+        names = zipfile.ZipFile(path).namelist()
+        self.assertEqual(len(names), len(set(names)))
+        self.assertTrue('photos/1.jpg' in names)
@@ -1,5 +1,23 @@
+import os
+import signal
+from datetime import date
+
+from mock import patch
+
+from carrier_pigeon.facility import add_items_to_push
+from carrier_pigeon.management.commands.pigeon_push import Command
+from carrier_pigeon.models import ItemToPush
+from carrier_pigeon.select import deferred_selection
+from carrier_pigeon.senders import DummySender
+from carrier_pigeon.registry import REGISTRY
+from carrier_pigeon.registry import sequential_rules_for_model
+
+from example_app.models import Story
+
 from example_app.tests.sequential.base import SequentialTests
 
+from django.contrib.auth.models import User
+from django.db import models
 from django.core.management import call_command
 
 
@@ -14,3 +32,93 @@ class BelovedPartnerTests(SequentialTests):
     def test_pigeon_push(self):
         call_command('pigeon_push')
         self._test_content()
+
+    def test_pigeon_push_daemon(self):
+        # Stop the daemon as soon as the queue is empty
+        stop = lambda interval: os.kill(os.getpid(), signal.SIGTERM)
+        with patch.object(Command, 'wait', side_effect=stop) as mock_wait:
+            call_command('pigeon_push', daemon=True)
+        mock_wait.assert_called_once_with(0.5)
+        self._test_content()
+
+    def test_add_items_to_push(self):
+        ItemToPush.objects.all().delete()
+        items = [(story, self.tested_configuration_name)
+                 for story in self.stories]
+        add_items_to_push(items + items)
+        self.assertEqual(ItemToPush.objects.new().count(), 2)
+        # Already queued items are not added twice
+        add_items_to_push(items)
+        self.assertEqual(ItemToPush.objects.new().count(), 2)
+
+    def test_deferred_selection(self):
+        ItemToPush.objects.all().delete()
+        story = self.stories[0]
+        with deferred_selection():
+            story.updating_date = date(2012, 5, 3)
+            story.save()
+            story.title = 'An egg & and a rooster'
+            story.save()
+            self.assertEqual(ItemToPush.objects.count(), 0)
+        # Both saves are selected at once
+        self.assertEqual(ItemToPush.objects.new().count(), 1)
+
+    def test_deferred_selection_next_save(self):
+        # Story.save() is Model.save(): reset the modified fields after it,
+        # as BasicDirtyFieldsMixin.save() does
+        def save(story, *args, **kwargs):
+            models.Model.save(story, *args, **kwargs)
+            story._reset_modified_attrs()
+        ItemToPush.objects.all().delete()
+        story = self.stories[0]
+        story._reset_modified_attrs()
+        with patch.object(Story, 'save', save):
+            with deferred_selection():
+                story.updating_date = date(2012, 5, 3)
+                story.save()
+            self.assertEqual(ItemToPush.objects.new().count(), 1)
+            ItemToPush.objects.all().delete()
+            # Only sees its own modifications
+            story.title = 'A rooster'
+            story.save()
+        self.assertEqual(ItemToPush.objects.count(), 0)
+
+    def test_deferred_selection_error(self):
+        ItemToPush.objects.all().delete()
+        story = self.stories[0]
+        try:
+            with deferred_selection():
+                story.updating_date = date(2012, 5, 3)
+                story.save()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(ItemToPush.objects.count(), 0)
+
+    def test_sequential_rules_for_model(self):
+        rule = REGISTRY[self.tested_configuration_name]
+        self.assertEqual(sequential_rules_for_model(Story), [rule])
+        self.assertEqual(sequential_rules_for_model(User), [])
+        # Rules set in the registry directly are routed too
+        try:
+            del REGISTRY[self.tested_configuration_name]
+            self.assertEqual(sequential_rules_for_model(Story), [])
+            other = REGISTRY['other'] = rule.__class__()
+            self.assertEqual(sequential_rules_for_model(Story), [other])
+        finally:
+            REGISTRY.pop('other', None)
+            REGISTRY[self.tested_configuration_name] = rule
+
+    def test_pigeon_push_batch(self):
+        rule = REGISTRY[self.tested_configuration_name]
+        rule.batch_push = True
+        try:
+            with patch.object(DummySender, 'deliver',
+                              return_value=True) as mock_deliver:
+                call_command('pigeon_push')
+        finally:
+            del rule.batch_push
+        self.assertEqual(mock_deliver.call_count, 1)
+        self.assertEqual(ItemToPush.objects.pushed().count(), 2)
+        self.assertEqual(ItemToPush.objects.exclude(
+            status=ItemToPush.STATUS.PUSHED).count(), 0)
@@ -15,6 +15,7 @@ setup(name='django-carrier-pigeon',
       author_email='devweb@liberation.fr',
       url='https://github.com/liberation/django-push-content',
       packages=['carrier_pigeon'],
+      package_data={'carrier_pigeon': ['sql/*.sql']},
       install_requires=[
           'paramiko',
       ]